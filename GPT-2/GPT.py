@@ -2,9 +2,23 @@ from dataclasses import dataclass
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 import inspect
 
+def enable_flash_attention():
+    """selects the SDPA backends once at setup, so forward has no backend context manager to trace;
+    bf16/fp16 CUDA attention dispatches to FlashAttention, math stays as the fp32 fallback"""
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(False)
+    torch.backends.cuda.enable_math_sdp(True)
+
+try:
+    # optional: fused residual add + LayerNorm Triton kernel
+    from flash_attn.ops.triton.layer_norm import layer_norm_fn
+except ImportError:
+    layer_norm_fn = None
+
 
 @dataclass
 class GPTConfig:
@@ -14,6 +28,8 @@ class GPTConfig:
     batch_size: int = 1
     n_layer: int = 12
     n_head: int = 12
+    loss_chunk_size: int = 1024
+    gradient_checkpointing: bool = False
 
     
 class MultiHeadedMaskedSelfAttention(nn.Module):
@@ -27,50 +43,33 @@ class MultiHeadedMaskedSelfAttention(nn.Module):
         super().__init__()
         
         self.config = config
+        assert config.n_embd % config.n_head == 0 and config.n_embd // config.n_head <= 256, \
+            "(alex) FlashAttention needs head_dim <= 256"
         self.c_attn = nn.Linear(config.n_embd, config.n_embd * 3)
         self.c_proj = nn.Linear(config.n_embd, config.n_embd)
         self.c_proj.RESIDUAL_LAYER = 1
         
         
-    def forward(self, x):
+    def _qkv(self, x):
+        """c_attn + head split as one view/permute (no split) so Inductor fuses it into the GEMM epilogue
+        
+        (B, T, 3 * C) -> (B, T, 3, nh, hd) -> 3 x (B, nh, T, hd)
+        """
         config = self.config
         B, T, C = x.size()
         qkv = self.c_attn(x)
-        q,k,v = qkv.split(split_size=config.n_embd, dim=2)
-        q = q.view(
-            B, 
-            T, 
-            config.n_head,
-            config.n_embd // config.n_head
-        ).transpose(1,2)
-        k = k.view(
-            B, 
-            T, 
-            config.n_head,
-            config.n_embd // config.n_head
-        ).transpose(1,2)
-        v = v.view(
-            B, 
-            T, 
-            config.n_head,
-            config.n_embd // config.n_head
-        ).transpose(1,2)
-        
-        """
-        attention = (q @ k.transpose(2,3)) * (1.0 / math.sqrt(k.size(-1)))
+        qkv = qkv.view(B, T, 3, config.n_head, config.n_embd // config.n_head)
+        return qkv.permute(2, 0, 3, 1, 4).unbind(0)
         
-        # this could be slow cause we are creating mask every time
-        masked_attention = F.softmax(
-            attention.masked_fill(
-                ~torch.tril(torch.ones_like(attention, dtype=torch.bool, device=attention.device)), 
-                float('-inf')),
-            dim=-1)
+    def forward(self, x):
+        config = self.config
+        B, T, C = x.size()
+        q, k, v = self._qkv(x)
         
-        out = masked_attention @ v
-        """
+        # (B, nh, T, hd) views with stride 1 on hd, as FlashAttention-2 expects;
+        # the backend is chosen once by enable_flash_attention()
         out = F.scaled_dot_product_attention(q, k, v, is_causal=True)
         
-        
         out = out.transpose(1,2).contiguous().view(B,T,config.n_embd)
         out = self.c_proj(out)
         return out
@@ -96,6 +95,15 @@ class MLP(nn.Module):
         return x
 
 
+def add_layer_norm(x, residual, ln):
+    """returns (ln(x + residual), x + residual) in a single pass over the activations:
+    flash-attn's Triton kernel when installed, otherwise Inductor fuses the add into the LayerNorm"""
+    if layer_norm_fn is not None and x.is_cuda:
+        return layer_norm_fn(x, ln.weight, ln.bias, residual=residual, eps=ln.eps, prenorm=True)
+    residual = x + residual
+    return ln(residual), residual
+
+
 class TransformerBlock(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -107,11 +115,56 @@ class TransformerBlock(nn.Module):
     
     def forward(self, x):
         attention = self.attn(self.ln_1(x))
-        x = attention + x
-        mlp = self.mlp(self.ln_2(x))
+        h, x = add_layer_norm(attention, x, self.ln_2)
+        mlp = self.mlp(h)
         x = mlp + x
         return x
 
+class LinearCrossEntropy(torch.autograd.Function):
+    """
+    lm_head matmul + mean cross entropy over chunks of rows, so the (B*T, V) logits are
+    never materialized; the gradients are computed chunk by chunk in forward (like
+    Liger-kernel FusedLinearCrossEntropy) and only rescaled in backward
+    
+    x: (N, C), weight: (V, C), targets: (N,)
+    """
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size):
+        N = x.size(0)
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+        for s in range(0, N, chunk_size):
+            xc, tc = x[s:s + chunk_size], targets[s:s + chunk_size]
+            logits = (xc @ weight.T).float()
+            lse = torch.logsumexp(logits, dim=-1)
+            loss += (lse - logits.gather(1, tc.unsqueeze(1)).squeeze(1)).sum()
+            # d loss / d logits = (softmax - one_hot) / N, reusing the logits buffer
+            grad = logits.sub_(lse.unsqueeze(1)).exp_()
+            grad[torch.arange(tc.size(0), device=tc.device), tc] -= 1
+            grad = (grad / N).to(xc.dtype)
+            grad_x[s:s + chunk_size] = grad @ weight.to(xc.dtype)
+            grad_weight += (grad.T @ xc).float()
+        ctx.save_for_backward(grad_x, grad_weight.to(weight.dtype))
+        return loss / N
+    
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_x, grad_weight = ctx.saved_tensors
+        return grad_x * grad_output, grad_weight * grad_output, None, None
+
+
+def linear_cross_entropy(x, weight, targets, chunk_size=1024):
+    """same as F.cross_entropy(x @ weight.T, targets) without materializing the logits"""
+    if torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad):
+        return LinearCrossEntropy.apply(x, weight, targets, chunk_size)
+    loss = torch.zeros((), dtype=torch.float32, device=x.device)
+    for s in range(0, x.size(0), chunk_size):
+        logits = (x[s:s + chunk_size] @ weight.T).float()
+        loss += F.cross_entropy(logits, targets[s:s + chunk_size], reduction="sum")
+    return loss / x.size(0)
+
+
 class GPT(nn.Module):
     def __init__(self, config, device='cuda'):
         super().__init__()
@@ -123,7 +176,8 @@ class GPT(nn.Module):
              ln_f = nn.LayerNorm(config.n_embd)
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
-        self.position_input = torch.tensor(range(config.block_size), device=device)
+        # static position ids, sliced to T in forward instead of a torch.arange every step
+        self.register_buffer("position_ids", torch.arange(0, config.block_size).unsqueeze(0), persistent=False)
         
         self.transformer.wte.weight = self.lm_head.weight
         
@@ -146,15 +200,25 @@ class GPT(nn.Module):
             if module.bias is not None:
                 torch.nn.init.zeros_(module.bias)
         
-    def forward(self, x):
+    def forward(self, x, targets=None):
+        """returns the logits (B, T, V), or (None, loss) when targets are given"""
         B, T = x.size()
         assert T <= self.config.block_size, f"(alex) Sequence too long! (length={T})"
-        x = self.transformer.wte(x) + self.transformer.wpe(torch.arange(0, T, dtype=torch.long, device=x.device))
+        x = self.transformer.wte(x) + self.transformer.wpe(self.position_ids[:, :T])
+        checkpointing = self.config.gradient_checkpointing and self.training and torch.is_grad_enabled()
         for block in self.transformer.h:
-            x = block(x)
+            # recompute the block activations in backward instead of keeping them alive
+            x = checkpoint(block, x, use_reentrant=False) if checkpointing else block(x)
         x = self.transformer.ln_f(x)
-        x = self.lm_head(x)
-        #x = x @ self.transformer.wte.weight.T
+        if targets is not None:
+            loss = linear_cross_entropy(
+                x.view(B * T, -1), 
+                self.transformer.wte.weight, 
+                targets.view(B * T), 
+                chunk_size=self.config.loss_chunk_size)
+            return None, loss
+        # lm_head is tied to wte, reading the embedding directly keeps the aliasing explicit for Inductor
+        x = F.linear(x, self.transformer.wte.weight)
         return x
     
     def configure_optimizer(self, weight_decay, learning_rate, device):
@@ -92,8 +92,11 @@ class DataLoader:
         """Dynamic getter for batch_step based on current batch size"""
         return self.batch_size  * self.config.block_size
 
-    def next_batch(self, mode="train", device='cpu', debug=True, batch_size=None):
-        """ mode=["train", "eval"] """
+    def next_batch(self, mode="train", device='cpu', debug=True, batch_size=None, pin_memory=False):
+        """ mode=["train", "eval"]
+        
+        pin_memory=True returns page-locked CPU tensors (device is ignored) so the caller
+        can issue a non_blocking host to device copy on its own stream"""
         if batch_size:
             self.batch_size = batch_size
         if mode == "train":
@@ -110,6 +113,8 @@ class DataLoader:
                   f" shard_loader.data_ix={shard_loader.data_ix}"
                   f" shard_loader.shard_ix={shard_loader.shard_ix}")
         buf = torch.tensor(shard_loader.get_next_tokens(self.batch_step + 1))
+        if pin_memory:
+            buf = buf.pin_memory()
         x = buf[:-1].view(self.batch_size, self.config.block_size)
         y = buf[1:].view(self.batch_size, self.config.block_size)
         if debug:
@@ -126,6 +131,8 @@ class DataLoader:
             t1 = time()
             print(f"[DataLoader.next_batch] batch_step={self.batch_step} completed in {t1 - t0}s")
     
+        if pin_memory:
+            return x, y
         return x.to(device), y.to(device)
     
    
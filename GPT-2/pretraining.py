@@ -33,13 +33,16 @@ import sys
 # subprocess.check_call([sys.executable, "-m", "pip", "install", "--upgrade", "datasets"])
 
 
-from GPT import GPT, GPTConfig
+from GPT import GPT, GPTConfig, enable_flash_attention
 from dataloader import DataLoader
 from evaluation import evaluate_downstream_cbt_with_probs
 from generate import sample_generations
 from utils import device, get_free_gpu_memory, LossLogs, save_checkpoint, load_checkpoint
 
 config = GPTConfig()
+# recomputes block activations in backward; only worth it with a larger (profiled) mini_batch_size,
+# and mini_batch_size * world_size must stay <= the start batch of get_batch_size for the ramp to apply
+config.gradient_checkpointing = False
 config.mini_batch_size = 32
 config.total_batch_size = 64*64
 config.block_size = 1024
@@ -50,6 +53,8 @@ config.dataset_directory = "tokenized_shards" # this is fineweb EDU 10BT
 config.tokenizer_name = "gpt2"
 config.downstream_evals_iterations = 500
 config.downstream_evals_frequency = 50
+config.log_frequency = 10 # iteration time, train loss and norm are read back (device syncs) every N epochs
+config.warmup_iterations = 3 # compile + autotuning happen here, outside of the logged loop
 
 """
 100k tokens/s
@@ -96,11 +101,10 @@ else:
 
 import torch
 import torch.nn.functional as F
-import gc
 
 print(f"[pretraining.py] Available GPU memory: {get_free_gpu_memory()[0]:,} MB")
 
-device = 'cuda' if torch.cuda.is_available else 'cpu'
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 if torch.cuda.is_available():
     current_device = torch.cuda.current_device()
@@ -127,16 +131,27 @@ config.vocab_size = 51200
 
 raw_model = GPT(config)
 raw_model.to(device)
-raw_model = torch.compile(raw_model)
+import torch._inductor.config
+torch._inductor.config.coordinate_descent_tuning = True
+# static (mini_batch_size, block_size) shapes; downstream evals and generation use the eager
+# raw_model since their sequence lengths vary and would recompile at every new length
+compiled_model = torch.compile(raw_model, mode="max-autotune", fullgraph=True, dynamic=False)
+# same as TORCH_LOGS=recompiles: the only expected ones are the first no_grad/eval validation
+# pass, anything after that is a shape or guard change worth fixing
+torch._logging.set_logs(recompiles=True)
 total_params = sum(p.numel() for p in raw_model.parameters())
 optimizer = raw_model.configure_optimizer(weight_decay=0.1, learning_rate=3e-4, device=device)
 print(f"Total parameters: {total_params:,}")
 if ddp:
-    model = DDP(raw_model, device_ids=[ddp_local_rank])
+    # position_ids is the only buffer and is constant; broadcasting it would also make the
+    # master-only validation forward wait on ranks that never join
+    model = DDP(compiled_model, device_ids=[ddp_local_rank], broadcast_buffers=False)
 else:
-    model = raw_model
+    model = compiled_model
 
+# "high" already runs fp32 matmuls on TF32 tensor cores (torch.backends.cuda.matmul.allow_tf32)
 torch.set_float32_matmul_precision("high")
+enable_flash_attention()
 
 NTPloss = LossLogs("NTP", wandb=wandb)
 
@@ -173,13 +188,47 @@ def get_batch_size(step, start_batch_size = 64*4):
     return config.total_batch_size
 
 
+# host to device copies of the next mini batch run on a side stream from pinned memory,
+# overlapping with forward/backward of the current one
+copy_stream = torch.cuda.Stream() if device.startswith('cuda') else None
+
+def prefetch_batch():
+    X, y = data_loader.next_batch(batch_size=config.mini_batch_size, debug=False, pin_memory=copy_stream is not None)
+    if copy_stream is None:
+        return X, y
+    with torch.cuda.stream(copy_stream):
+        return X.to(device, non_blocking=True), y.to(device, non_blocking=True)
+
+def wait_for_batch(X, y):
+    if copy_stream is None:
+        return X, y
+    current_stream = torch.cuda.current_stream()
+    current_stream.wait_stream(copy_stream)
+    # X, y were allocated on copy_stream, keep the allocator from reusing them too early
+    X.record_stream(current_stream)
+    y.record_stream(current_stream)
+    return X, y
+
+
+# warmup with the training shapes so compilation is not attributed to the first iterations,
+# no optimizer step so the weights are untouched
+for _ in range(config.warmup_iterations):
+    X = torch.randint(0, config.vocab_size, (config.mini_batch_size, config.block_size), device=device)
+    with torch.autocast(device_type=device, dtype=torch.bfloat16):
+        _, warmup_loss = model(X, X)
+    warmup_loss.backward()
+optimizer.zero_grad(set_to_none=True)
+
+
 #training loop --------------
 
 
-from time import time
+start_event = torch.cuda.Event(enable_timing=True)
+end_event = torch.cuda.Event(enable_timing=True)
 train_epoch = -1
 tokens = 1
-optimizer.zero_grad()
+optimizer.zero_grad(set_to_none=True)
+next_X, next_y = prefetch_batch()
 while True:
     
     train_epoch += 1
@@ -188,16 +237,20 @@ while True:
     total_batch_iteration_time = 0
     batch_size = get_batch_size(tokens)
     epoch_train_loss = torch.tensor(0.0, device=device)
-    t0, new_tokens = time(), 0
-    mini_batch_steps = int(batch_size / (config.mini_batch_size * ddp_world_size))
+    new_tokens = 0
+    logged = train_epoch % config.log_frequency == 0
+    if logged:
+        start_event.record()
+    # at least one step: early batch sizes are below mini_batch_size * ddp_world_size on many ranks,
+    # those steps run (and log) more sequences than get_batch_size asked for
+    mini_batch_steps = max(1, int(batch_size / (config.mini_batch_size * ddp_world_size)))
     for mini_batch_step in range(mini_batch_steps):
     
-        bb = config.mini_batch_size * config.block_size
-        X, y = data_loader.next_batch(device=device, batch_size=config.mini_batch_size, debug=False)
+        X, y = wait_for_batch(next_X, next_y)
         new_tokens += X.shape[0] * X.shape[1]
+        # fp32 master weights, autocast casts them to bf16 per op (an extra weight read per matmul)
         with torch.autocast(device_type=device, dtype=torch.bfloat16):
-            logits = model(X)
-            train_loss = F.cross_entropy(logits.view(bb, -1), y.view(bb))
+            _, train_loss = model(X, y)
             
         train_loss = train_loss / mini_batch_steps
         epoch_train_loss += train_loss.detach()
@@ -205,6 +258,7 @@ while True:
         if ddp:
             model.require_backward_grad_sync = (mini_batch_step == mini_batch_steps - 1)
         train_loss.backward()  
+        next_X, next_y = prefetch_batch()
     if ddp:
         dist.all_reduce(epoch_train_loss, op=dist.ReduceOp.AVG)
         
@@ -215,31 +269,34 @@ while True:
         param_group['lr'] = lr
 
     optimizer.step()
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
     
     # log infra metricsb 
-    torch.cuda.synchronize()    
-    t1 = time()
-    dt = (t1 - t0) * 1000 
     new_tokens = new_tokens*ddp_world_size
     tokens += new_tokens
-    tps = 1000*new_tokens/dt
 
-    infra_metrics = {
-        'infra/iteration_time(ms)': dt,
-        'infra/tokens_per_second': tps,
+    infra_metrics = {}
+    if logged:
+        end_event.record()
+        end_event.synchronize()
+        dt = start_event.elapsed_time(end_event)
+        infra_metrics['infra/iteration_time(ms)'] = dt
+        infra_metrics['infra/tokens_per_second'] = 1000*new_tokens/dt
+    infra_metrics.update({
         'training/tokens': tokens,
         'training/norm': norm,
-        'training/batch_size': batch_size,
+        'training/batch_size': mini_batch_steps * config.mini_batch_size * ddp_world_size,
         'training/learning_rate': lr,
         'training/mini_batch_steps': mini_batch_steps,
-    }
-    NTPloss.log_train(train_epoch, epoch_train_loss.item(), infra_metrics=infra_metrics)
+    })
+    if logged:
+        NTPloss.log_train(train_epoch, epoch_train_loss.item(), infra_metrics=infra_metrics)
 
     if master_process:
-        loss_string = f"[{train_epoch}*{mini_batch_steps}/{config.epochs}][GPU {ddp_rank}/{ddp_world_size}] global stats: train_loss={epoch_train_loss.item():.3f}"
-        infra_string = ", ".join([f"{k}={v:.6f}" for k,v in infra_metrics.items()])
-        print(loss_string + infra_string)
+        if logged:
+            loss_string = f"[{train_epoch}*{mini_batch_steps}/{config.epochs}][GPU {ddp_rank}/{ddp_world_size}] global stats: train_loss={epoch_train_loss.item():.3f}"
+            infra_string = ", ".join([f"{k}={v:.6f}" for k,v in infra_metrics.items()])
+            print(loss_string + infra_string)
 
 
 
@@ -248,7 +305,7 @@ while True:
             
             try: 
                 accuracy, _, skipped = evaluate_downstream_cbt_with_probs(
-                    model=model,
+                    model=raw_model,
                     tokenizer=data_loader.tokenizer,
                     device=device,
                     dataset_split="validation",
@@ -262,7 +319,7 @@ while True:
                 })
 
                 generated_evals = sample_generations(
-                    model, 
+                    raw_model, 
                     data_loader.tokenizer, 
                     config, 
                     device=device,
@@ -276,24 +333,21 @@ while True:
         if (train_epoch + 1) % config.validation_frequency == 0:
             model.eval()
             with torch.no_grad():
-                epoch_val_losses = []
+                # copied into a device buffer (cudagraph outputs are overwritten by the next replay),
+                # read back once for the whole validation pass
+                epoch_val_losses = torch.empty(config.validation_epochs, device=device)
                 for val_epoch in range(config.validation_epochs):
                     X, y = data_loader.next_batch(mode="eval", device=device, batch_size=config.mini_batch_size, debug=False)
-                    logits = model(X)
-                    bb = config.mini_batch_size * config.block_size
-                    val_loss = F.cross_entropy(logits.view(bb, -1), y.view(bb))
-                    NTPloss.log_val(train_epoch, val_epoch, val_loss.item())
-
-                    del X, y, logits
-                    gc.collect()
-                    torch.cuda.empty_cache()
-
-
-                    model.train()
-                    loss_string = f"[{train_epoch}/{config.epochs}] train_loss={epoch_train_loss.item():.3f},val_loss={NTPloss.get_val_loss(train_epoch):.3f}, "
-                    loss_string += f", norm={norm}"
-                    infra_string = ", ".join([f"{k}={v:.3f}" for k,v in infra_metrics.items()])
-                    print(loss_string + infra_string)
+                    _, val_loss = model(X, y)
+                    epoch_val_losses[val_epoch] = val_loss
+                for val_epoch, val_loss in enumerate(epoch_val_losses.tolist()):
+                    NTPloss.log_val(train_epoch, val_epoch, val_loss)
+
+            model.train()
+            loss_string = f"[{train_epoch}/{config.epochs}] train_loss={epoch_train_loss.item():.3f},val_loss={NTPloss.get_val_loss(train_epoch):.3f}, "
+            loss_string += f", norm={norm}"
+            infra_string = ", ".join([f"{k}={v:.3f}" for k,v in infra_metrics.items()])
+            print(loss_string + infra_string)
 
                     
 if ddp:
@@ -10,7 +10,7 @@ import torch
 import torch.nn.functional as F
 import math
 
-from GPT import GPT, GPTConfig
+from GPT import GPT, GPTConfig, add_layer_norm
 
 # from generate import generate
 
@@ -80,6 +80,74 @@ def test_model_implementation():
     assert local_result == hf_result, "models generating different output"
     print("TEST PASSED: local model generate same inference as hugging face model")
     
+
+def test_linear_cross_entropy():
+    # B*T = 48 rows, loss_chunk_size = 7 leaves a partial last chunk
+    config = GPTConfig(block_size=16, vocab_size=50, n_embd=32, n_layer=2, n_head=4, loss_chunk_size=7)
+    B, T, V = 3, config.block_size, config.vocab_size
+    torch.manual_seed(0)
+    gpt = GPT(config)
+    X, Y = torch.randint(0, V, (B, T)), torch.randint(0, V, (B, T))
+
+    _, loss = gpt(X, Y)
+    loss.backward()
+    grads = {n: p.grad.clone() for n, p in gpt.named_parameters()}
+    gpt.zero_grad()
+    expected = F.cross_entropy(gpt(X).view(-1, V), Y.view(-1))
+    expected.backward()
+    assert torch.allclose(loss, expected, atol=1e-6), "fused loss differs from F.cross_entropy"
+    for n, p in gpt.named_parameters():
+        assert torch.allclose(grads[n], p.grad, atol=1e-6), f"wrong gradient for {n}"
+    print("TEST PASSED: fused linear cross entropy loss and gradients")
+
+    with torch.no_grad():
+        _, loss = gpt(X, Y)
+    assert torch.allclose(loss, expected, atol=1e-6), "no_grad fused loss differs from F.cross_entropy"
+    print("TEST PASSED: fused linear cross entropy under no_grad")
+    
+
+def test_add_layer_norm():
+    # on CUDA with flash-attn installed this exercises the fused Triton kernel
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    ln = nn.LayerNorm(32).to(device)
+    nn.init.normal_(ln.weight)
+    nn.init.normal_(ln.bias)
+    x = torch.randn(3, 16, 32, device=device, requires_grad=True)
+    residual = torch.randn(3, 16, 32, device=device, requires_grad=True)
+
+    h, summed = add_layer_norm(x, residual, ln)
+    (h.square().sum() + summed.sum()).backward()
+    grads = [t.grad.clone() for t in (x, residual, ln.weight, ln.bias)]
+    for t in (x, residual, ln.weight, ln.bias): t.grad = None
+    expected_summed = x + residual
+    expected_h = ln(expected_summed)
+    (expected_h.square().sum() + expected_summed.sum()).backward()
+    assert torch.allclose(summed, expected_summed, atol=1e-5), "wrong residual sum"
+    assert torch.allclose(h, expected_h, atol=1e-5), "add_layer_norm differs from ln(x + residual)"
+    for grad, t in zip(grads, (x, residual, ln.weight, ln.bias)):
+        assert torch.allclose(grad, t.grad, atol=1e-4), "wrong add_layer_norm gradient"
+    print("TEST PASSED: add_layer_norm same as ln(x + residual)")
+    
+
+def test_gradient_checkpointing():
+    config = GPTConfig(block_size=16, vocab_size=50, n_embd=32, n_layer=2, n_head=4)
+    torch.manual_seed(0)
+    gpt = GPT(config)
+    X, Y = torch.randint(0, 50, (3, 16)), torch.randint(0, 50, (3, 16))
+
+    _, loss = gpt(X, Y)
+    loss.backward()
+    grads = {n: p.grad.clone() for n, p in gpt.named_parameters()}
+    gpt.zero_grad()
+    gpt.config.gradient_checkpointing = True
+    _, checkpointed_loss = gpt(X, Y)
+    checkpointed_loss.backward()
+    assert torch.allclose(loss, checkpointed_loss), "checkpointing changed the loss"
+    for n, p in gpt.named_parameters():
+        assert torch.allclose(grads[n], p.grad, atol=1e-6), f"checkpointing changed the gradient of {n}"
+    print("TEST PASSED: gradient checkpointing same loss and gradients")
+    
     
 if __name__ == "__main__":
     #test_model_sanity()
@@ -21,7 +21,7 @@ def get_free_gpu_memory():
         return None
     
 
-device = 'cuda' if torch.cuda.is_available else 'cpu'
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 if torch.cuda.is_available():
     current_device = torch.cuda.current_device()
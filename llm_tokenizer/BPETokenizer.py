@@ -1,72 +1,153 @@
 """a simple Byte Pair Enconding (BPE) Tokenizer from Karpathy tokenizers class"""
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import os
+import pickle
+import numpy as np
 
-@dataclass
-class TokenPair:
-    first_token: int
-    second_token: int
-    frequency: int = 1
-    
-    def _key(self):
-        return (self.first_token, self.second_token)
-    
-    def __lt__(self, other):
-        return self.frequency < other.frequency
-    
-    def to_string(self):
-        return chr(self.first_token) + chr(self.second_token)
+
+def pack(a, b):
+    """pair (a, b) as the int64 key (a << 32) | b"""
+    return (a << 32) | b
+
+def unpack(key):
+    return key >> 32, key & 0xFFFFFFFF
+
+
+# tokens per count() strip: 1 MiB of int32, so the per strip sort and histogram stay in L2
+COUNT_CHUNK = 1 << 18
+
+def pair_histogram(tokens, offset=0):
+    """returns (keys, counts, positions) of the adjacent pairs in tokens, positions[k] are the
+    left indices (shifted by offset) of keys[k]"""
+    keys = pack(tokens[:-1].astype(np.int64), tokens[1:].astype(np.int64))
+    order = np.argsort(keys, kind="stable")
+    uniq, starts, cnts = np.unique(keys[order], return_index=True, return_counts=True)
+    return uniq.tolist(), cnts.tolist(), np.split(order + offset, starts[1:])
+
+
+class _LegacyTokenPair:
+    """stand-in for the removed TokenPair dataclass, tokenizers pickled
+    before stored it as decoding_map values"""
+
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == "TokenPair":
+            return _LegacyTokenPair
+        return super().find_class(module, name)
 
 
 class Tokenizer:
     """a simple Byte Pair Enconding (BPE) Tokenizer from Karpathy tokenizers class"""
-    def __init__(self, tokens, encoding_vocab_size=276, raw_tokens=True, name="tinyshakespeare", path_prefix=None):
+    def __init__(self, tokens, encoding_vocab_size=276, raw_tokens=True, name="tinyshakespeare", path_prefix=None, num_workers=None):
         if not raw_tokens: tokens = tokens.encode('utf-8')
         self.name = name
+        self.num_workers = num_workers or os.cpu_count()
         self.path_prefix=path_prefix
         self.encoding_vocab_size = encoding_vocab_size
-        self._original_tokens, self.encoded_tokens = tokens, tokens 
+        self._original_tokens, self.tokens = tokens, self._to_array(tokens)
+        # doubly linked list over positions: merging the pair at i writes the
+        # minted token in tokens[i] and unlinks next[i], positions never move
+        n = len(self.tokens)
+        self.prev = np.arange(-1, n - 1, dtype=np.int32)
+        self.next = np.arange(1, n + 1, dtype=np.int32)
+        if n: self.next[-1] = -1
+        self.alive = np.ones(n, dtype=bool)
         self.mint_token = 256
-        self.count(self.encoded_tokens)
+        self.count(self.tokens)
         self.decoding_map, self.encoding_map = {}, {}
         
+    @staticmethod
+    def _to_array(tokens):
+        if isinstance(tokens, (bytes, bytearray)):
+            return np.frombuffer(tokens, dtype=np.uint8).astype(np.int32)
+        return np.asarray(tokens, dtype=np.int32)
+
+    @property
+    def encoded_tokens(self):
+        return self.tokens[self.alive]
+
     def count(self, tokens):
-        self.tcounts = {}
-        for i, token in enumerate(tokens[:-1]):
-            tp = TokenPair(token, tokens[i+1])
-            if self.tcounts.get(tp._key(), None):
-                self.tcounts[tp._key()].frequency += 1
-            else:
-                self.tcounts[tp._key()] = tp
+        """builds tcounts (key -> frequency), positions (key -> left indices) and the max-heap
+        
+        pairs are histogrammed with np.unique on the packed int64 key (a << 32) | b, one
+        COUNT_CHUNK strip at a time (strips overlap by one token so no pair is lost) and reduced
+        into the global dicts; afterwards swap_top only updates the neighbourhood of each merge
+        
+        strips are histogrammed on num_workers threads (numpy releases the GIL while sorting),
+        the reduce stays on the calling thread"""
+        self.tcounts, self.positions = {}, {}
+        starts = range(0, max(len(tokens) - 1, 0), COUNT_CHUNK)
+        strip_histogram = lambda start: pair_histogram(tokens[start:start + COUNT_CHUNK + 1], start)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for histogram in executor.map(strip_histogram, starts):
+                for key, cnt, positions in zip(*histogram):
+                    self.tcounts[key] = self.tcounts.get(key, 0) + cnt
+                    self.positions.setdefault(key, set()).update(positions.tolist())
+        self.heap = [(-cnt, key) for key, cnt in self.tcounts.items()]
+        heapq.heapify(self.heap)
+
+    def _add_pair(self, key, i):
+        self.tcounts[key] = self.tcounts.get(key, 0) + 1
+        self.positions.setdefault(key, set()).add(i)
+        heapq.heappush(self.heap, (-self.tcounts[key], key))
+
+    def _remove_pair(self, key, i):
+        self.positions[key].discard(i)
+        self.tcounts[key] -= 1
+        if self.tcounts[key]:
+            heapq.heappush(self.heap, (-self.tcounts[key], key))
+        else:
+            del self.tcounts[key], self.positions[key]
         
     def get_most_common(self):
-        return max(self.tcounts.values())
+        """returns ((a, b), frequency) of the most common pair, ties go to the pair
+        occurring first in the sequence (the smallest left index)"""
+        # lazy deletion: heap entries whose frequency is out of date are dropped here
+        tied = []
+        while self.heap:
+            neg_freq, key = heapq.heappop(self.heap)
+            if self.tcounts.get(key) != -neg_freq: continue
+            if tied and neg_freq != tied[0][0]:
+                heapq.heappush(self.heap, (neg_freq, key))
+                break
+            tied.append((neg_freq, key))
+        if not tied: return None
+        for entry in tied: heapq.heappush(self.heap, entry)
+        neg_freq, key = min(tied, key=lambda entry: min(self.positions[entry[1]]))
+        return unpack(key), -neg_freq
     
     def swap_top(self, debug=False):
         """ returns True if finished encoding """
-        top_tp = self.get_most_common()
-        if debug: print(top_tp)
-        if top_tp.frequency == 1: return True
-        a, b = top_tp.first_token, top_tp.second_token
-
-        new_encoding, idx = [], 0
-        while idx < len(self.encoded_tokens) - 1:
-            A, B = self.encoded_tokens[idx], self.encoded_tokens[idx+1]
-            if a == A and b == B:
-                new_encoding.append(self.mint_token)
-                idx += 2
-            else:
-                new_encoding.append(A)
-                idx += 1
-        if idx < len(self.encoded_tokens): new_encoding.append(self.encoded_tokens[idx])
-        self.encoded_tokens = new_encoding
-        self.decoding_map[self.mint_token] = top_tp
-        self.encoding_map[top_tp._key()] = self.mint_token
+        top = self.get_most_common()
+        if debug: print(top)
+        if top is None or top[1] == 1: return True
+        (a, b), new = top[0], self.mint_token
+        key = pack(a, b)
+
+        tokens, prev, next = self.tokens, self.prev, self.next
+        for i in sorted(self.positions[key]):
+            # already consumed by an overlapping merge, e.g. (a, a) in a run of a
+            if i not in self.positions.get(key, ()): continue
+            j = next[i]
+            p, n = prev[i], next[j]
+            self._remove_pair(key, i)
+            if p != -1:
+                self._remove_pair(pack(int(tokens[p]), a), p)
+                self._add_pair(pack(int(tokens[p]), new), p)
+            if n != -1:
+                self._remove_pair(pack(b, int(tokens[n])), j)
+                self._add_pair(pack(new, int(tokens[n])), i)
+                prev[n] = i
+            tokens[i], next[i], self.alive[j] = new, n, False
+        self.decoding_map[self.mint_token] = (a, b)
+        self.encoding_map[(a, b)] = self.mint_token
         
         self.mint_token += 1
         if debug and self.mint_token % 10 == 0 : print(f"[Tokenizer.swap_top] {self.mint_token}")
-        self.count(self.encoded_tokens)
         if debug: print(self.encoded_tokens)
-        return max(self.encoded_tokens) + 1 == self.encoding_vocab_size
+        return self.mint_token == self.encoding_vocab_size
             
     def train(self, debug=False):
         """returns the encoded training set"""
@@ -84,8 +165,6 @@ class Tokenizer:
         return res
 
     def save_to_file(self):     
-        import pickle
-
         # An arbitrary collection of objects supported by pickle.
         data = {
             'encoding_map': self.encoding_map,
@@ -97,57 +176,79 @@ class Tokenizer:
             pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
             
     def load_from_file(self):
-        import pickle
-
         with open(self._filename(), 'rb') as f:
             # The protocol version used is detected automatically, so we do not
             # have to specify it.
-            data = pickle.load(f)
+            data = _Unpickler(f).load()
             self.encoding_map = data['encoding_map']
-            self.decoding_map = data['decoding_map']
+            self.decoding_map = {
+                token: (tp.first_token, tp.second_token) if isinstance(tp, _LegacyTokenPair) else tp
+                for token, tp in data['decoding_map'].items()
+            }
         
     
     def decode(self, encoded_tokens, debug=False, raw_tokens=True):
-        decoded = False
+        """each pass splits every minted token into its pair, writing into a preallocated
+        buffer (len(tokens) + number of minted tokens) instead of appending to a list"""
+        tokens = np.asarray(encoded_tokens, dtype=np.int64)
+        size = max(max(self.decoding_map, default=0), int(tokens.max(initial=0))) + 1
+        first, second = np.zeros(size, dtype=np.int64), np.zeros(size, dtype=np.int64)
+        minted = np.zeros(size, dtype=bool)
+        if self.decoding_map:
+            keys = np.fromiter(self.decoding_map.keys(), dtype=np.int64)
+            pairs = np.array(list(self.decoding_map.values()), dtype=np.int64)
+            first[keys], second[keys], minted[keys] = pairs[:, 0], pairs[:, 1], True
         
-        while not decoded:
-            decoded = True
-            decoded_tokens = []
-            for token in encoded_tokens:
-                tp = self.decoding_map.get(token, None)
-                if tp:
-                    decoded = False
-                    decoded_tokens.append(tp.first_token)
-                    decoded_tokens.append(tp.second_token)
-                else:
-                    decoded_tokens.append(token)
-            encoded_tokens = decoded_tokens
+        mask = minted[tokens]
+        while mask.any():
+            # token k lands at k + (number of minted tokens before k)
+            idx = np.arange(len(tokens)) + np.cumsum(mask) - mask
+            out = np.empty(len(tokens) + int(mask.sum()), dtype=np.int64)
+            out[idx] = np.where(mask, first[tokens], tokens)
+            out[idx[mask] + 1] = second[tokens[mask]]
+            tokens = out
+            mask = minted[tokens]
+        decoded_tokens = tokens.tolist()
         if debug: print(decoded_tokens)
         if raw_tokens:
             return decoded_tokens
         return bytes(decoded_tokens).decode('utf-8', errors="replace")
     
     def encode(self, decoded_tokens, debug=False, raw_tokens=True):
+        """single pass of merges in rank order (the minted token is the rank of its pair)
+        over a linked list of tokens, driven by a min-heap of (rank, position)"""
         if not raw_tokens:
             decoded_tokens = list(decoded_tokens.encode("utf-8"))
-        encoded = False
+        merge_rank = self.encoding_map
+        tokens = list(decoded_tokens)
+        n = len(tokens)
+        prev, next = list(range(-1, n - 1)), list(range(1, n + 1))
+        if n: next[-1] = -1
         
-        while not encoded:
-            encoded, idx = True, 0
-            encoded_tokens = []
-            while idx < len(decoded_tokens) - 1:
-                tp = TokenPair(decoded_tokens[idx], decoded_tokens[idx+1])
-                encoded_token = self.encoding_map.get(tp._key(), None)
-                if encoded_token:
-                    encoded_tokens.append(encoded_token)
-                    idx += 2
-                    encoded = False
-                else:
-                    encoded_tokens.append(tp.first_token)
-                    idx += 1
-            if idx < len(decoded_tokens): encoded_tokens.append(decoded_tokens[idx])
-            decoded_tokens = encoded_tokens
-            
+        heap = []
+        for i in range(n - 1):
+            rank = merge_rank.get((tokens[i], tokens[i+1]))
+            if rank is not None: heap.append((rank, i))
+        heapq.heapify(heap)
+        
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = next[i]
+            # stale entry: position i was merged away or its pair changed
+            if tokens[i] is None or j == -1 or merge_rank.get((tokens[i], tokens[j])) != rank: continue
+            tokens[i], tokens[j] = rank, None
+            n_ = next[j]
+            next[i] = n_
+            if n_ != -1: prev[n_] = i
+            p = prev[i]
+            if p != -1:
+                rank = merge_rank.get((tokens[p], tokens[i]))
+                if rank is not None: heapq.heappush(heap, (rank, p))
+            if n_ != -1:
+                rank = merge_rank.get((tokens[i], tokens[n_]))
+                if rank is not None: heapq.heappush(heap, (rank, i))
+        
+        encoded_tokens = [token for token in tokens if token is not None]
         if debug: print(encoded_tokens)
         return encoded_tokens
     
@@ -159,14 +260,14 @@ class Tokenizer:
                 if token < 256:
                     return chr(token) if 32 <= token < 127 else f"[{token}]"
                 elif token in self.decoding_map:
-                    first = decode_token(self.decoding_map[token].first_token)
-                    second = decode_token(self.decoding_map[token].second_token)
+                    first = decode_token(self.decoding_map[token][0])
+                    second = decode_token(self.decoding_map[token][1])
                     return first + second
                 else:
                     return f"[{token}]"
 
-            first = decode_token(token_pair.first_token)
-            second = decode_token(token_pair.second_token)
+            first = decode_token(token_pair[0])
+            second = decode_token(token_pair[1])
             merged = first + second
             print(f"'{first}' '{second}' -> '{merged}' (Token {minted_token})")
 
@@ -1,41 +1,58 @@
-from BPETokenizer import Tokenizer, TokenPair
+import BPETokenizer
+from BPETokenizer import Tokenizer, pack, unpack
 
-def test_token_pair():
-    assert TokenPair(10, 10, 5) < TokenPair(11, 11, 6)
-    assert not TokenPair(10, 10, 7) < TokenPair(11, 10, 6)
-    print("TEST PASSED TokenPair")
+def test_pack():
+    assert unpack(pack(10, 11)) == (10, 11)
+    assert pack(10, 11) < pack(11, 10)
+    print("TEST PASSED pack")
+
+def test_count_strips():
+    # strips of a few tokens overlap by one, every pair must still be counted exactly once
+    tokens = [1,1,1,1,2,2,2,2,2,2,3] * 3 + list(b"the cat sat on the mat")
+    single = Tokenizer(tokens, encoding_vocab_size=270)
+    tcounts, positions = dict(single.tcounts), {k: set(v) for k, v in single.positions.items()}
+    encoded = single.train().tolist()
+    default_chunk = BPETokenizer.COUNT_CHUNK
+    try:
+        for chunk in range(1, 6):
+            BPETokenizer.COUNT_CHUNK = chunk
+            t = Tokenizer(tokens, encoding_vocab_size=270, num_workers=2)
+            assert t.tcounts == tcounts
+            assert t.positions == positions
+            assert t.train().tolist() == encoded
+            assert t.encoding_map == single.encoding_map
+    finally:
+        BPETokenizer.COUNT_CHUNK = default_chunk
+    print("TEST PASSED Tokenizer.count over strips same as a single strip")
 
 def test_tokenizer_class():
     # basic API testing
     t = Tokenizer([1,1,1,1,2,2,2,2,2,2,3])
-    assert t.get_most_common().first_token == 2
-    assert t.get_most_common().second_token == 2
-    assert t.get_most_common().frequency == 5
-    assert t.get_most_common().first_token == 2
-    assert t.get_most_common().second_token == 2
+    assert t.get_most_common() == ((2, 2), 5)
+    assert t.get_most_common() == ((2, 2), 5)
     t = Tokenizer([1,1,2,2,2,3])
-    assert t.get_most_common().first_token == 2
-    assert t.get_most_common().second_token == 2
-    assert t.get_most_common().frequency == 2
+    assert t.get_most_common() == ((2, 2), 2)
+    t = Tokenizer([3,4,9,1,2,3,4,9,1,2])
+    assert t.get_most_common() == ((3, 4), 2)
     print("TEST PASSED Tokenizer.get_most_common")
 
     t = Tokenizer([1,1,1,1,2,2,2,2,2,2,3])
     assert not t.swap_top(debug=True)
-    assert t.encoded_tokens == [1,1,1,1,256,256,256,3]
+    assert t.encoded_tokens.tolist() == [1,1,1,1,256,256,256,3]
     assert not t.swap_top(debug=True)
-    assert t.encoded_tokens == [257,257,256,256,256,3]
+    assert t.encoded_tokens.tolist() == [257,257,256,256,256,3]
     assert not t.swap_top(debug=True)
-    assert t.encoded_tokens == [257,257,258,256,3]
+    assert t.encoded_tokens.tolist() == [257,257,258,256,3]
     assert t.swap_top(debug=True)
     print("TEST PASSED Tokenizer.swap_top")
 
     t = Tokenizer([1,1,1,1,2,2,2,2,2,2,3])
-    assert t.train() == [257,257,258,256,3]
+    assert t.train().tolist() == [257,257,258,256,3]
     t = Tokenizer([2,2,2,2])
-    assert t.train(debug=True) == [256, 256]
+    assert t.train(debug=True).tolist() == [256, 256]
     print("TEST PASSED Tokenizer.train")
     t = Tokenizer([1,1,1,1,2,2,2,2,2,2,3], 258)
-    assert t.train() == [257,257,256,256,256,3]
+    assert t.train().tolist() == [257,257,256,256,256,3]
     print("TEST PASSED Tokenizer.train with limited vocabulary size")
 
     assert t.decode([257,257,256,256,256,3], debug=True) == [1,1,1,1,2,2,2,2,2,2,3]
@@ -43,6 +60,14 @@ def test_tokenizer_class():
     assert t.encode([1,1,1,1,2,2,2,2,2,2,3], debug=True) == [257,257,256,256,256,3]
     assert t.encode([2,2], debug=True) == [256]
     print("TEST PASSED Tokenizer.encode")
+
+    # (2, 3) was minted before (1, 2): rank order gives [1, 256], left to right greedy would give [257, 3]
+    t = Tokenizer([])
+    t.encoding_map = {(2, 3): 256, (1, 2): 257}
+    t.decoding_map = {256: (2, 3), 257: (1, 2)}
+    assert t.encode([1,2,3], debug=True) == [1, 256]
+    assert t.decode([1, 256]) == [1,2,3]
+    print("TEST PASSED Tokenizer.encode merges in rank order")
     
 def test_tokenizer_usecases():
 